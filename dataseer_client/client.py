@@ -3,19 +3,147 @@ import io
 import json
 import argparse
 import time
+import random
+import threading
 import concurrent.futures
-import ntpath
 import requests
+from requests.adapters import HTTPAdapter
 import pathlib
 import gzip
+import zlib
+import contextlib
+import logging
+import logging.handlers
+import queue
+import sys
+import atexit
+
+try:
+    # optional libdeflate binding, faster than zlib to decompress .pdf.gz input files
+    import deflate
+except ImportError:
+    deflate = None
+
+# suffix of the TEI files produced by the service
+OUTPUT_SUFFIX = ".dataseer.tei.xml"
+
+# input file suffixes accepted by each service
+INPUT_SUFFIXES = {
+    "processDataseerPDF": (".pdf", ".pdf.gz"),
+    "processDataseerTEI": (".tei.xml",),
+}
+
+# number of requests kept in flight per worker, so that a worker never waits for the next file
+IN_FLIGHT_PER_WORKER = 2
+
+# chunk size used when streaming a TEI response to disk
+RESPONSE_CHUNK_SIZE = 1 << 20
+
+# read buffer size for the input files, the only buffering level between the disk and the socket,
+# large enough to feed zlib big blocks for .pdf.gz files
+INPUT_BUFFER_SIZE = 1 << 18
+
+# errors raised when reading an input file, including corrupted .pdf.gz files
+INPUT_ERRORS = (OSError, EOFError, zlib.error)
+
+# retry policy when the server is overloaded or unreachable, used when not set in the config
+# (the base delay is the configured sleep_time)
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_MAX_SLEEP_TIME = 60
+RETRY_STATUS_CODES = (429, 503)
+
+# circuit breaker defaults: consecutive failures before failing fast, and seconds before probing again
+DEFAULT_CIRCUIT_FAILURE_THRESHOLD = 10
+DEFAULT_CIRCUIT_RECOVERY_TIME = 30
+
+
+logger = logging.getLogger(__name__)
+
+
+class _UnformattedQueueHandler(logging.handlers.QueueHandler):
+    """Enqueue the records as they are, so that messages are formatted by the listener thread
+    rather than by the worker which logged them"""
+
+    def prepare(self, record):
+        return record
 
 
 class ServerUnavailableException(Exception):
     pass
 
 
+class CircuitBreaker:
+    """Shared between the workers: once the server failed failure_threshold times in a row
+    (timeouts, connection errors, 5xx other than overload replies), no request is sent for
+    recovery_time seconds, then a single probe request is let through to find out if the
+    server is back"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    # tickets returned by allow()
+    PASS = "pass"
+    PROBE = "probe"
+
+    def __init__(self, failure_threshold, recovery_time):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return False if no request can be sent to the server, otherwise PASS, or PROBE for
+        the single caller let through to probe the server. The caller hands this ticket back
+        with the outcome of its request"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return self.PASS
+            if self.state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+                # others keep waiting until the probe reports back
+                self.state = self.HALF_OPEN
+                return self.PROBE
+            return False
+
+    def wait_time(self):
+        """Return how long a caller refused by allow() should wait before asking again"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return max(0, self._opened_at + self.recovery_time - time.monotonic())
+            # half-open: check again later for the outcome of the probe request
+            return self.recovery_time
+
+    def record_success(self, ticket):
+        with self._lock:
+            if ticket == self.PROBE:
+                self.state = self.CLOSED
+            if self.state == self.CLOSED:
+                self._failures = 0
+
+    def release(self, ticket):
+        """Hand the ticket back without a verdict, when the request never reached the server"""
+        with self._lock:
+            if ticket == self.PROBE and self.state == self.HALF_OPEN:
+                # the next caller becomes the probe
+                self.state = self.OPEN
+
+    def record_failure(self, ticket):
+        with self._lock:
+            self._failures += 1
+            # only the probe decides for a half-open breaker, requests let through before the
+            # breaker opened do not change its state
+            if (ticket == self.PROBE and self.state == self.HALF_OPEN) or (
+                self.state == self.CLOSED and self._failures >= self.failure_threshold
+            ):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
 class DataseerClient:
     def __init__(self, config_path=None):
+        self._start_console_logging()
         self.endpoint_isalive = "isalive"
         self.endpoint_tei = "processDataseerTEI"
         self.endpoint_pdf = "processDataseerPDF"
@@ -24,21 +152,119 @@ class DataseerClient:
         if len(self.config["dataseer_port"]) > 0:
             self.service_url += ":" + self.config["dataseer_port"]
         self.service_url += "/service/"
+        self.url_pdf = self.service_url + self.endpoint_pdf
+        self.url_tei = self.service_url + self.endpoint_tei
+
+        # one session for the client lifetime, so that connections to the server are kept alive
+        # and reused across requests instead of being re-opened for every file
+        self.session = requests.Session()
+        self._adapter_size = 0
+        self._mount_adapter(10)
+
+        # worker pool, created on first call to process() and kept across batches
+        self._executor = None
+        self._executor_size = 0
+
+        # output directories already created, so that mkdir is only called once per directory
+        self._known_dirs = set()
+        self._known_dirs_lock = threading.Lock()
+
+        self.breaker = CircuitBreaker(
+            self.config.get("circuit_failure_threshold", DEFAULT_CIRCUIT_FAILURE_THRESHOLD),
+            self.config.get("circuit_recovery_time", DEFAULT_CIRCUIT_RECOVERY_TIME),
+        )
 
         self._test_server_connection()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Shut down the worker pool and release the pooled HTTP connections"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.session.close()
+        self._stop_console_logging()
+
+    def _start_console_logging(self):
+        """When the application did not configure logging, print the messages to the console as
+        before, through a queue so that the workers never write to stdout themselves"""
+        self._log_listener = None
+        if logger.hasHandlers():
+            return
+        log_queue = queue.SimpleQueue()
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter("%(message)s"))
+        self._log_handler = _UnformattedQueueHandler(log_queue)
+        self._previous_log_level = logger.level
+        self._previous_log_propagate = logger.propagate
+        logger.addHandler(self._log_handler)
+        logger.setLevel(logging.INFO)
+        # while installed, this fallback is the only output, even if the application configures
+        # logging later on, so that messages are not printed twice
+        logger.propagate = False
+        self._log_listener = logging.handlers.QueueListener(log_queue, console_handler)
+        self._log_listener.start()
+        # flush the pending records if the client is never closed
+        atexit.register(self._stop_console_logging)
+
+    def _stop_console_logging(self):
+        if self._log_listener is None:
+            return
+        atexit.unregister(self._stop_console_logging)
+        logger.removeHandler(self._log_handler)
+        logger.setLevel(self._previous_log_level)
+        logger.propagate = self._previous_log_propagate
+        self._log_listener.stop()
+        self._log_listener = None
+        self._log_handler = None
+
+    def _mount_adapter(self, n):
+        """Mount an HTTP adapter with a connection pool sized to the number of workers"""
+        if self._adapter_size == n:
+            return
+        # all the requests go to the single Dataseer host, so one host pool is enough, with
+        # room for more connections than workers so that no worker waits for a free connection
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=n * 2, max_retries=0)
+        previous_adapter = self.session.get_adapter(self.service_url)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        previous_adapter.close()
+        self._adapter_size = n
+
+    def _start_executor(self, n):
+        """Create the worker pool, or re-create it if the number of workers changed"""
+        if self._executor is not None and self._executor_size == n:
+            return
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        # the work is network-bound (waiting on the server), so threads sharing the session are enough
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+        self._executor_size = n
+
     def _load_config(self, path="./config.json"):
-        """Load the json configuration"""
-        config_json = open(path).read()
-        self.config = json.loads(config_json)
+        """Load the json configuration, and keep the values used for every request as attributes"""
+        with open(path) as config_file:
+            self.config = json.load(config_file)
+        self.timeout = self.config["timeout"]
+        self.sleep_time = self.config["sleep_time"]
+        self.batch_size = self.config["batch_size"]
+        self.max_retries = self.config.get("max_retries", DEFAULT_MAX_RETRIES)
+        self.max_sleep_time = self.config.get("max_sleep_time", DEFAULT_MAX_SLEEP_TIME)
+        # only for servers decoding gzip-encoded multipart parts
+        self.send_compressed_pdf = self.config.get("send_compressed_pdf", False)
 
     def _test_server_connection(self):
         """Test if the server is up and running."""
         the_url = self.service_url + self.endpoint_isalive
         try:
-            r = requests.get(the_url)
+            r = self.session.get(the_url)
         except:
-            print(
+            logger.error(
                 "Dataseer server does not appear up and running, the connection to the server failed"
             )
             raise ServerUnavailableException
@@ -46,195 +272,316 @@ class DataseerClient:
         status = r.status_code
 
         if status != 200:
-            print("Dataseer server does not appear up and running " + str(status))
+            logger.warning("Dataseer server does not appear up and running %s", status)
         else:
-            print("Dataseer server is up and running")
+            logger.info("Dataseer server is up and running")
 
     def _output_file_name(self, input_file, input_path, output):
-        # we use ntpath here to be sure it will work on Windows too
-        if output is not None:
-            input_file_name = str(os.path.relpath(os.path.abspath(input_file), input_path))
-            filename = os.path.join(
-                output, os.path.basename(input_file_name).split(".")[0] + ".dataseer.tei.xml"
-            )
-        else:
-            input_file_name = ntpath.basename(input_file)
-            filename = os.path.join(
-                ntpath.dirname(input_file),
-                os.path.basename(input_file_name).split(".")[0] + ".dataseer.tei.xml",
-            )
-
-        return filename
+        # os.path is ntpath on Windows, so this works there too
+        input_dir, input_file_name = os.path.split(input_file)
+        # the name up to the first dot, as always, so that outputs of earlier runs are found
+        input_file_name = input_file_name.partition(".")[0]
+        if output is None:
+            # written next to the input file
+            output = input_dir
+        return os.path.join(output, input_file_name + OUTPUT_SUFFIX)
 
     def process(self, service, input_path, output=None, n=10, force=True, verbose=False):
+        self._mount_adapter(n)
+        self._start_executor(n)
+
         start_time = time.time()
-        nb_total = 0
-        print(f"\nDataseer - total process: {nb_total} - accumulated runtime: 0 s - 0 PDF/s\n")
-
-        batch_size_files = self.config["batch_size"]
-        input_files = []
-
-        for (dirpath, dirnames, filenames) in os.walk(input_path):
-            for filename in filenames:
-                if (
-                    service == "processDataseerPDF"
-                    and (filename.endswith(".pdf.gz") or filename.endswith(".pdf"))
-                    ) or (
-                    service == "processDataseerTEI" and filename.endswith(".tei.xml")
-                ):
-                    if verbose:
-                        try:
-                            print(f"Dataseer - {filename}")
-                        except Exception:
-                            # may happen on linux see https://stackoverflow.com/questions/27366479/python-3-os-walk-file-paths-unicodeencodeerror-utf-8-codec-cant-encode-s
-                            pass
-                    input_files.append(os.sep.join([dirpath, filename]))
-
-                    if len(input_files) == batch_size_files:
-                        self.process_batch(
-                            service,
-                            input_files,
-                            input_path,
-                            output,
-                            n,
-                            force,
-                            verbose,
-                        )
-                        runtime = round(time.time() - start_time, 3)
-                        nb_total += len(input_files)
-                        print(
-                            f"\nDataseer - total process: {nb_total} - accumulated runtime: {runtime}s - {round(nb_total/runtime, 2)} PDF/s\n"
-                        )
-                        input_files = []
-
-        # last batch
-        if len(input_files) > 0:
-            self.process_batch(
-                service,
-                input_files,
-                input_path,
-                output,
-                n,
-                force,
-                verbose,
-            )
+        logger.info("\nDataseer - total process: 0 - accumulated runtime: 0 s - 0 PDF/s\n")
+
+        # output file names are derived once, when the input file is found
+        jobs = (
+            (input_file, self._output_file_name(input_file, input_path, output))
+            for input_file in self._iter_inputs(input_path, service, verbose)
+        )
+        self._process_files(service, jobs, input_path, output, n, force, verbose, start_time)
+
+    def _scan_files(self, root):
+        """Recursively yield the DirEntry of every file under root, os.scandir giving the file
+        types from the directory listing without an extra stat per file. Directories which cannot
+        be listed are logged and skipped"""
+        subdirs = []
+        try:
+            it = os.scandir(root)
+        except OSError as e:
+            # skip directories which cannot be listed, as os.walk does
+            logger.warning("Dataseer - cannot list directory %s, skipping: %s", root, e)
+            return
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif entry.is_file():
+                    yield entry
+        for subdir in subdirs:
+            yield from self._scan_files(subdir)
+
+    def _iter_inputs(self, root, service, verbose=False):
+        """Yield the input files to be processed by the service, as they are found under root"""
+        suffixes = INPUT_SUFFIXES[service]
+        for entry in self._scan_files(root):
+            # TEI files produced by an earlier run are not inputs
+            if entry.name.endswith(suffixes) and not entry.name.endswith(OUTPUT_SUFFIX):
+                if verbose:
+                    # file names not encodable in the console encoding may happen on linux, see
+                    # https://stackoverflow.com/questions/27366479/python-3-os-walk-file-paths-unicodeencodeerror-utf-8-codec-cant-encode-s
+                    # the log handler reports them without interrupting the walk
+                    logger.info("Dataseer - %s", entry.name)
+                yield entry.path
+
+    def _existing_output_files(self, input_path, output):
+        """Return the set of TEI output files already produced, gathered with a single scan"""
+        if output is None:
+            # output files are written next to their input file
+            return {
+                entry.path
+                for entry in self._scan_files(input_path)
+                if entry.name.endswith(OUTPUT_SUFFIX)
+            }
+        if not os.path.isdir(output):
+            return set()
+        with os.scandir(output) as it:
+            return {entry.path for entry in it if entry.name.endswith(OUTPUT_SUFFIX)}
 
     def process_batch(self, service, input_files, input_path, output, n, force, verbose=False):
         if verbose:
-            print(f"\nDataseer - {len(input_files)} files to process in current batch\n")
-
-        # with concurrent.futures.ThreadPoolExecutor(max_workers=n) as executor:
-        with concurrent.futures.ProcessPoolExecutor(max_workers=n) as executor:
-            results = []
-            for input_file in input_files:
-                # check if TEI file is already produced
-                filename = self._output_file_name(input_file, input_path, output)
-                if not force and os.path.isfile(filename):
-                    print(
-                        f"Dataseer - {filename} already exist, skipping... (use --force to reprocess pdf input files)"
-                    )
-                    continue
+            logger.info("\nDataseer - %s files to process in current batch\n", len(input_files))
 
-                selected_process = self.process_tei
-                if service == self.endpoint_pdf:
-                    selected_process = self.process_pdf
+        self._start_executor(n)
+        jobs = [
+            (input_file, self._output_file_name(input_file, input_path, output))
+            for input_file in input_files
+        ]
+        self._process_files(service, jobs, input_path, output, n, force, verbose)
 
-                r = executor.submit(selected_process, service, input_file)
+    def _process_files(
+        self, service, jobs, input_path, output, n, force, verbose=False, start_time=None
+    ):
+        """Submit the (input file, output file) jobs to the worker pool as they come, keeping a
+        bounded number of requests in flight, the workers writing each result as soon as it is
+        available"""
+        selected_process = self.process_tei
+        if service == self.endpoint_pdf:
+            selected_process = self.process_pdf
 
-                results.append(r)
+        # check if TEI files are already produced with a set lookup instead of a stat per file
+        existing_outputs = set() if force else self._existing_output_files(input_path, output)
 
-        for r in concurrent.futures.as_completed(results):
-            input_file, status, text = r.result()
-            filename = self._output_file_name(input_file, input_path, output)
+        max_in_flight = n * IN_FLIGHT_PER_WORKER
+        pending = set()
+        nb_total = 0
+        next_report = self.batch_size
 
-            if text is None:
-                print(f"Dataseer - Processing of {input_file} failed with error {status}")
-            else:
-                # writing TEI file
-                try:
-                    pathlib.Path(os.path.dirname(filename)).mkdir(parents=True, exist_ok=True)
-                    with open(filename, "w", encoding="utf8") as tei_file:
-                        tei_file.write(text)
-                except OSError:
-                    print(f"Dataseer - Writing resulting TEI XML file {filename} failed")
-
-    def process_pdf(self, service, pdf_file):
-        url = self.service_url + self.endpoint_pdf
-        if pdf_file.endswith('.pdf.gz'):
-            the_file = {'input': gzip.open(pdf_file, 'rb')}
-        else:
-            the_file = {'input': open(pdf_file, 'rb')}
-        try:
-            response = requests.post(url, files=the_file, timeout=self.config["timeout"])
-            tei_data = None
-            if response.status_code == 503:
-                print(
-                    "Info: service overloaded, sleep " + str(self.config["sleep_time"]) + " seconds"
+        for input_file, filename in jobs:
+            if filename in existing_outputs:
+                logger.info(
+                    "Dataseer - %s already exist, skipping... (use --force to reprocess pdf input files)",
+                    filename,
                 )
-                time.sleep(self.config["sleep_time"])
-                return self.process_tei(service, pdf_file)
-            elif response.status_code >= 500:
-                print("Error: [{0}] Server Error ".format(response.status_code) + pdf_file)
-            elif response.status_code == 404:
-                print("Error: [{0}] URL not found: [{1}] ".format(response.status_code + url))
-            elif response.status_code >= 400:
-                print("Error: [{0}] Bad Request".format(response.status_code))
-                print("Error: ", response.content)
-            elif response.status_code == 200:
-                tei_data = response.text
-                # note: in case the recognizer has found no software in the document, it will still return
-                # a json object as result, without mentions, but with MD5 and page information
+                nb_total += 1
             else:
-                print(
-                    "Error: Unexpected Error: [HTTP {0}]: Content: {1}".format(
-                        response.status_code, response.content
+                if len(pending) >= max_in_flight:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED
                     )
-                )
+                    for r in done:
+                        self._report_result(r.result())
+                    nb_total += len(done)
+                pending.add(self._executor.submit(selected_process, service, input_file, filename))
 
-        except requests.exceptions.Timeout:
-            print("Exception:  The request to the annotation service has timeout")
-        except requests.exceptions.TooManyRedirects:
-            print("Exception:  The request failed due to too many redirects")
-        except requests.exceptions.RequestException:
-            print("Exception:  The request failed")
-        finally:
-            return (pdf_file, response.status_code, tei_data)
+            if start_time is not None and nb_total >= next_report:
+                self._log_progress(nb_total, start_time)
+                next_report = nb_total + self.batch_size
 
-    def process_tei(self, service, tei_file):
-        url = self.service_url + self.endpoint_tei
-        the_file = {'input': open(tei_file, 'rb')}
+        for r in concurrent.futures.as_completed(pending):
+            self._report_result(r.result())
+            nb_total += 1
+            if start_time is not None and nb_total >= next_report:
+                self._log_progress(nb_total, start_time)
+                next_report = nb_total + self.batch_size
+
+        # closing summary, unless the last progress line already gave the final count
+        if start_time is not None and next_report - self.batch_size != nb_total:
+            self._log_progress(nb_total, start_time)
+
+    def _log_progress(self, nb_total, start_time):
+        runtime = round(time.time() - start_time, 3)
+        rate = round(nb_total / runtime, 2) if runtime > 0 else 0
+        logger.info(
+            "\nDataseer - total process: %s - accumulated runtime: %ss - %s PDF/s\n",
+            nb_total,
+            runtime,
+            rate,
+        )
+
+    def _report_result(self, result):
+        input_file, status, output_file = result
+        if output_file is None:
+            logger.error("Dataseer - Processing of %s failed with error %s", input_file, status)
+
+    def _make_output_dir(self, dirname):
+        if dirname in self._known_dirs:
+            return
+        with self._known_dirs_lock:
+            if dirname not in self._known_dirs:
+                pathlib.Path(dirname).mkdir(parents=True, exist_ok=True)
+                self._known_dirs.add(dirname)
+
+    def _save_response(self, response, output_file):
+        """Stream the body of a successful response into the TEI output file. The body goes to a
+        temporary file first, renamed once complete, so that an interrupted transfer never leaves
+        a truncated TEI file behind"""
+        # one worker thread handles one file at a time, so the thread id makes the name unique
+        tmp_file = f"{output_file}.{threading.get_ident()}.part"
         try:
-            response = requests.post(url, files=the_file, timeout=self.config["timeout"])
-            tei_data = None
-            if response.status_code == 503:
-                print(
-                    "Info: service overloaded, sleep " + str(self.config["sleep_time"]) + " seconds"
-                )
-                time.sleep(self.config["sleep_time"])
-                return self.process_tei(service, tei_file)
-            elif response.status_code >= 500:
-                print("Error: [{0}] Server Error ".format(response.status_code) + tei_file)
-            elif response.status_code == 404:
-                print("Error: [{0}] URL not found: [{1}] ".format(response.status_code + url))
-            elif response.status_code >= 400:
-                print("Error: [{0}] Bad Request".format(response.status_code))
-                print("Error: ", response.content)
-            elif response.status_code == 200:
-                tei_data = response.text
-                # note: in case the recognizer has found no software in the document, it will still return
-                # a json object as result, without mentions, but with MD5 and page information
+            self._make_output_dir(os.path.dirname(output_file))
+            try:
+                with open(tmp_file, "wb") as tei_file:
+                    for chunk in response.iter_content(chunk_size=RESPONSE_CHUNK_SIZE):
+                        tei_file.write(chunk)
+                os.replace(tmp_file, output_file)
+            except BaseException:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp_file)
+                raise
+        except OSError:
+            logger.error("Dataseer - Writing resulting TEI XML file %s failed", output_file)
+            return None
+        return output_file
+
+    @contextlib.contextmanager
+    def _open_pdf(self, pdf_file):
+        """Open a PDF input file as the multipart input field. A .pdf.gz file is sent as is if
+        the server is configured to accept gzip-encoded parts, and decompressed otherwise"""
+        with open(pdf_file, 'rb', buffering=INPUT_BUFFER_SIZE) as raw_file:
+            if not pdf_file.endswith('.pdf.gz'):
+                yield raw_file
             else:
-                print(
-                    "Error: Unexpected Error: [HTTP {0}]: Content: {1}".format(
-                        response.status_code, response.content
+                # the part is named after the PDF whatever the way it is sent
+                pdf_name = os.path.basename(pdf_file)[:-len('.gz')]
+                if self.send_compressed_pdf:
+                    yield (pdf_name, raw_file, 'application/pdf', {'Content-Encoding': 'gzip'})
+                elif deflate is not None:
+                    try:
+                        pdf_data = deflate.gzip_decompress(raw_file.read())
+                    except (ValueError, deflate.DeflateError) as e:
+                        # bad header or corrupted data, reported like the gzip module does
+                        raise gzip.BadGzipFile(f"Invalid gzip file {pdf_file}: {e}") from e
+                    yield (pdf_name, io.BytesIO(pdf_data))
+                else:
+                    with gzip.GzipFile(fileobj=raw_file, mode='rb') as gz_file:
+                        yield (pdf_name, gz_file)
+
+    def _post_with_retry(self, url, open_input):
+        """POST the input file opened by open_input() to url, retrying with exponential backoff
+        and full jitter while the server is overloaded or unreachable. While the circuit breaker
+        is open, an attempt waits for the end of the recovery time instead; None is returned if
+        it is still open for the last attempt"""
+        max_retries = self.max_retries
+        for attempt in range(max_retries + 1):
+            ticket = self.breaker.allow()
+            if not ticket:
+                if attempt == max_retries:
+                    return None
+                # jitter, so that the waiting workers do not all ask again at the same time
+                time.sleep(self.breaker.wait_time() + random.uniform(0, self.sleep_time))
+                continue
+            response = None
+            # None while the server has not been reached, then whether it answered sanely
+            server_ok = None
+            try:
+                # the input is re-opened for every attempt, as a previous post consumed it
+                with open_input() as the_input:
+                    response = self.session.post(
+                        url, files={'input': the_input}, timeout=self.timeout, stream=True
                     )
+                # overload replies are handled by the backoff below, the server is up
+                server_ok = (
+                    response.status_code < 500 or response.status_code in RETRY_STATUS_CODES
                 )
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                server_ok = False
+                if attempt == max_retries:
+                    raise
+            except requests.exceptions.RequestException:
+                server_ok = False
+                raise
+            finally:
+                # always report back, so that a probe request never leaves the breaker half-open
+                if server_ok is None:
+                    self.breaker.release(ticket)
+                elif server_ok:
+                    self.breaker.record_success(ticket)
+                else:
+                    self.breaker.record_failure(ticket)
+
+            if response is not None:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == max_retries:
+                    return response
+                response.close()
+
+            # full jitter: uniform in [0, min(cap, base * 2^attempt)]
+            sleep_time = random.uniform(
+                0, min(self.max_sleep_time, self.sleep_time * 2 ** attempt)
+            )
+            logger.info(
+                "Info: service overloaded or unreachable, sleep %s seconds", round(sleep_time, 3)
+            )
+            time.sleep(sleep_time)
+
+    def _post(self, url, input_file, open_input, output_file):
+        """Send an input file to the service at url and write the resulting TEI to output_file,
+        returning (input_file, status, output_file or None on failure)"""
+        response = None
+        result_file = None
+        try:
+            response = self._post_with_retry(url, open_input)
+            if response is None:
+                logger.info("Info: server keeps failing, skipping %s", input_file)
+                return (input_file, 503, None)
+            with response:
+                if response.status_code >= 500:
+                    logger.error("Error: [%s] Server Error %s", response.status_code, input_file)
+                elif response.status_code == 404:
+                    logger.error("Error: [%s] URL not found: [%s] ", response.status_code, url)
+                elif response.status_code >= 400:
+                    logger.error("Error: [%s] Bad Request", response.status_code)
+                    logger.error("Error: %s", response.content)
+                elif response.status_code == 200:
+                    result_file = self._save_response(response, output_file)
+                    # note: in case the recognizer has found no software in the document, it will still return
+                    # a json object as result, without mentions, but with MD5 and page information
+                else:
+                    logger.error(
+                        "Error: Unexpected Error: [HTTP %s]: Content: %s",
+                        response.status_code,
+                        response.content,
+                    )
 
         except requests.exceptions.Timeout:
-            print("Exception:  The request to the annotation service has timeout")
+            logger.error("Exception:  The request to the annotation service has timeout")
         except requests.exceptions.TooManyRedirects:
-            print("Exception:  The request failed due to too many redirects")
+            logger.error("Exception:  The request failed due to too many redirects")
         except requests.exceptions.RequestException:
-            print("Exception:  The request failed")
-        finally:
-            return (tei_file, response.status_code, tei_data)
+            logger.error("Exception:  The request failed")
+        except INPUT_ERRORS as e:
+            # missing, unreadable or corrupted input file, only this file fails
+            logger.error("Exception:  Reading input file %s failed: %s", input_file, e)
+
+        status = response.status_code if response is not None else None
+        return (input_file, status, result_file)
+
+    def process_pdf(self, service, pdf_file, output_file):
+        return self._post(self.url_pdf, pdf_file, lambda: self._open_pdf(pdf_file), output_file)
+
+    def process_tei(self, service, tei_file, output_file):
+        return self._post(
+            self.url_tei,
+            tei_file,
+            lambda: open(tei_file, 'rb', buffering=INPUT_BUFFER_SIZE),
+            output_file,
+        )